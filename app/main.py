@@ -1,16 +1,24 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request, Response
+from sqlalchemy import select, update, insert, delete, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from typing import List, Dict
+from contextlib import asynccontextmanager
 import os
 from dotenv import load_dotenv
 import json
-from fastapi.responses import JSONResponse
+import hashlib
+import orjson
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from . import models, schemas
+from . import models, schemas, openai_client
 from .database import engine, get_db
 from .services.receipt_processor import ReceiptProcessor
 from .services.recipe_recommender import RecipeRecommender
+from .services.ttl_cache import TTLCache
 
 # Load environment variables
 load_dotenv()
@@ -18,7 +26,51 @@ load_dotenv()
 # Create database tables
 models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="Pantry Tracker API")
+def _merge_case_duplicates(connection, table):
+    """Fold rows whose names differ only by case into the oldest one, summing their quantities.
+
+    Databases created before names were stored lowercase can hold pairs like 'Milk' and 'milk',
+    which would stop the unique lower(name) index from being built.
+    """
+    lower_name = func.lower(table.c.name)
+    duplicates = connection.execute(
+        select(
+            lower_name.label("name"),
+            func.min(table.c.id).label("keep_id"),
+            func.sum(table.c.quantity).label("quantity")
+        ).group_by(lower_name).having(func.count() > 1)
+    ).all()
+    for duplicate in duplicates:
+        drop_ids = select(table.c.id).where(lower_name == duplicate.name, table.c.id != duplicate.keep_id)
+        if table is models.Ingredient.__table__:
+            connection.execute(
+                update(models.recipe_ingredients)
+                .where(models.recipe_ingredients.c.ingredient_id.in_(drop_ids))
+                .values(ingredient_id=duplicate.keep_id)
+            )
+        # Delete before renaming, the kept row takes the lowercase name the duplicate may hold
+        connection.execute(delete(table).where(table.c.id.in_(drop_ids)))
+        connection.execute(
+            update(table)
+            .where(table.c.id == duplicate.keep_id)
+            .values(name=duplicate.name, quantity=duplicate.quantity)
+        )
+
+# create_all skips tables that already exist, so add any indexes declared since they were created
+with engine.begin() as connection:
+    for model in (models.Ingredient, models.ToBuy):
+        _merge_case_duplicates(connection, model.__table__)
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Close the shared OpenAI connection pool when the app shuts down
+    await openai_client.aclose()
+
+app = FastAPI(title="Pantry Tracker API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -32,17 +84,44 @@ app.add_middleware(
 receipt_processor = ReceiptProcessor()
 recipe_recommender = RecipeRecommender()
 
-@app.post("/upload-receipt/")
+# Common pantry staples that don't need to be in the pantry
+COMMON_INGREDIENTS = frozenset({
+    'olive oil', 'vegetable oil', 'salt', 'black pepper', 'garlic', 'onion',
+    'sugar', 'flour', 'baking powder', 'baking soda', 'vanilla extract',
+    'cinnamon', 'paprika', 'oregano', 'basil', 'thyme', 'rosemary',
+    'butter', 'milk', 'eggs', 'water'
+})
+
+# Recommendations are cached per pantry snapshot and prompt, so repeat requests skip the LLM.
+# Any pantry write changes the snapshot hash, which invalidates the old entries.
+RECIPE_CACHE_MAX_ENTRIES = 256
+RECIPE_CACHE_TTL_SECONDS = 60 * 60
+recipe_cache = TTLCache(RECIPE_CACHE_MAX_ENTRIES, RECIPE_CACHE_TTL_SECONDS)
+
+def _rows_etag(rows) -> str:
+    """Build an ETag from the raw column values of a list endpoint's rows."""
+    digest = hashlib.blake2b(orjson.dumps([tuple(row) for row in rows]), digest_size=16)
+    return f'"{digest.hexdigest()}"'
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True  # Matches any current representation (RFC 9110)
+    return etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+@app.post("/upload-receipt/", response_model=schemas.ReceiptUploadResponse)
 async def upload_receipt(file: UploadFile = File(...), db: Session = Depends(get_db)):
     """Upload and process a receipt image to add items to the pantry."""
     if not receipt_processor.can_process:
         raise HTTPException(status_code=503, detail="Receipt processing service is not available. Check API key and dependencies.")
     try:
-        # Read the uploaded file
-        contents = await file.read()
+        # Hand the spooled upload file to the processor instead of reading it into memory
+        await file.seek(0)
         
         # Process the receipt with Vision model
-        items = await receipt_processor.process_receipt_image(contents)
+        items = await receipt_processor.process_receipt_image(file.file)
         
         # Method used is now always Vision model if processor is active
         method_used = "OpenAI GPT-4o mini Vision"
@@ -50,36 +129,65 @@ async def upload_receipt(file: UploadFile = File(...), db: Session = Depends(get
         # Add items to database
         added_items = []
         if items:
-            for item in items:
-                item_dict = item if isinstance(item, dict) else item.dict()
-                
-                # Check if ingredient already exists
-                existing_ingredient = db.query(models.Ingredient).filter(
-                    models.Ingredient.name == item_dict["name"]
-                ).first()
-                
+            item_dicts = [item if isinstance(item, dict) else item.model_dump() for item in items]
+            
+            # Fetch every ingredient already in the pantry in a single query
+            names = {item_dict["name"].lower() for item_dict in item_dicts}
+            existing = {
+                ing.name.lower(): ing
+                for ing in db.scalars(
+                    select(models.Ingredient).where(func.lower(models.Ingredient.name).in_(names))
+                )
+            }
+            
+            # Split into quantity bumps for existing rows and inserts for new ones,
+            # merging repeated receipt lines for the same item
+            updates = {}
+            inserts = {}
+            for item_dict in item_dicts:
+                name = item_dict["name"].lower()
+                existing_ingredient = existing.get(name)
                 if existing_ingredient:
                     # Add to existing quantity
-                    existing_ingredient.quantity += item_dict["quantity"]
-                    added_items.append(existing_ingredient)
-                else:
-                    # Create new ingredient
-                    new_ingredient = models.Ingredient(
-                        name=item_dict["name"],
-                        quantity=item_dict["quantity"],
-                        unit=item_dict["unit"],
-                        category=item_dict["category"],
-                        min_quantity=round(item_dict["quantity"] * 0.2, 2)  # Set minimum quantity to 20% of initial quantity, rounded to 2 decimal places
+                    update_row = updates.setdefault(
+                        name, {"id": existing_ingredient.id, "quantity": existing_ingredient.quantity}
                     )
-                    db.add(new_ingredient)
-                    added_items.append(new_ingredient)
+                    update_row["quantity"] += item_dict["quantity"]
+                elif name in inserts:
+                    inserts[name]["quantity"] += item_dict["quantity"]
+                    inserts[name]["min_quantity"] = round(inserts[name]["quantity"] * 0.2, 2)
+                else:
+                    inserts[name] = {
+                        "name": name,
+                        "quantity": item_dict["quantity"],
+                        "unit": item_dict["unit"],
+                        "category": item_dict["category"],
+                        "min_quantity": round(item_dict["quantity"] * 0.2, 2)  # Set minimum quantity to 20% of initial quantity, rounded to 2 decimal places
+                    }
+            
+            if updates:
+                db.execute(
+                    update(models.Ingredient),
+                    list(updates.values()),
+                    execution_options={"synchronize_session": False}
+                )
+                for name, update_row in updates.items():
+                    # Reflect the new quantity without scheduling another UPDATE
+                    set_committed_value(existing[name], "quantity", update_row["quantity"])
+                    added_items.append(existing[name])
+            
+            if inserts:
+                added_items.extend(db.scalars(
+                    insert(models.Ingredient).returning(models.Ingredient),
+                    list(inserts.values())
+                ))
             
             db.commit()
         
         return {
             "message": "Receipt processed successfully",
             "items_added": len(added_items),
-            "items": [schemas.Ingredient.from_orm(item) for item in added_items],
+            "items": added_items,
             "debug": {
                 "raw_items": items,
                 "method_used": method_used
@@ -91,53 +199,84 @@ async def upload_receipt(file: UploadFile = File(...), db: Session = Depends(get
     finally:
         await file.close()
 
-@app.get("/recipes/recommend")
-async def get_recipe_recommendations(
-    user_prompt: str = None,
-    db: Session = Depends(get_db)
-):
-    """Get recipe recommendations based on available ingredients in the pantry and optional user prompt."""
-    # Get all ingredients from the database
-    ingredients = db.query(models.Ingredient).all()
-    
-    # Common pantry staples that don't need to be in the pantry
-    common_ingredients = {
-        'olive oil', 'vegetable oil', 'salt', 'black pepper', 'garlic', 'onion',
-        'sugar', 'flour', 'baking powder', 'baking soda', 'vanilla extract',
-        'cinnamon', 'paprika', 'oregano', 'basil', 'thyme', 'rosemary',
-        'butter', 'milk', 'eggs', 'water'
-    }
+def _load_recommender_pantry(db: Session):
+    """
+    Load the pantry in the format the recommender expects, plus a lookup by lowercase name
+    and the set of names a recommended recipe may use.
+    """
+    # Load only the columns the recommender needs
+    ingredients = db.execute(select(
+        models.Ingredient.name,
+        models.Ingredient.quantity,
+        models.Ingredient.unit,
+        models.Ingredient.category
+    )).all()
     
-    # Convert to dictionary format for easier lookup
-    ingredients_dict = {
-        ing.name.lower(): {
+    ingredients_dict = {}
+    ingredients_list = []
+    for ing in ingredients:
+        ingredient_data = {
             "name": ing.name,
             "quantity": ing.quantity,
             "unit": ing.unit,
             "category": ing.category
         }
-        for ing in ingredients
-    }
+        ingredients_dict[ing.name.lower()] = ingredient_data
+        ingredients_list.append(ingredient_data)
     
     if not ingredients_dict:
         raise HTTPException(
             status_code=400,
             detail="No ingredients found in pantry. Please add some ingredients first."
         )
+    pantry_keys = ingredients_dict.keys() - COMMON_INGREDIENTS  # Common staples are never listed
+    return ingredients_dict, ingredients_list, pantry_keys
+
+def _recipe_cache_key(ingredients_list: List[Dict], user_prompt: str):
+    pantry_key = hashlib.sha256(orjson.dumps(ingredients_list)).hexdigest()
+    prompt_key = " ".join(user_prompt.lower().split()) if user_prompt else ""
+    return (pantry_key, prompt_key)
+
+def _filter_recipe(recipe, ingredients_dict: Dict, pantry_keys) -> Dict | None:
+    """Keep only the ingredients we have, capped at the available quantity. Returns None if none are usable."""
+    # Ensure recipe is a dictionary with a list of ingredients
+    if not isinstance(recipe, dict) or not isinstance(recipe.get("ingredients"), list):
+        return None
     
-    # Convert ingredients to the format expected by the recommender
-    ingredients_list = [
-        {
-            "name": ing.name,
-            "quantity": ing.quantity,
-            "unit": ing.unit,
-            "category": ing.category
-        }
-        for ing in ingredients
-    ]
+    recipe_ingredients = [ing for ing in recipe["ingredients"] if isinstance(ing, dict)]
+    usable = {ing.get("name", "").lower() for ing in recipe_ingredients} & pantry_keys
+    if not usable:
+        return None
+    
+    # Only include ingredients we have and adjust quantity to what's available
+    available_ingredients = []
+    for ingredient in recipe_ingredients:
+        item_name = ingredient.get("name", "").lower()
+        if item_name in usable:
+            available = ingredients_dict[item_name]
+            available_ingredients.append({
+                "name": ingredient["name"],
+                "quantity": min(ingredient.get("quantity", 0), available["quantity"]),
+                "unit": ingredient.get("unit", available["unit"])
+            })
+    
+    # Copy rather than mutate, the recipe may be shared with the cache
+    return {**recipe, "ingredients": available_ingredients}
+
+@app.get("/recipes/recommend")
+async def get_recipe_recommendations(
+    user_prompt: str = None,
+    db: Session = Depends(get_db)
+):
+    """Get recipe recommendations based on available ingredients in the pantry and optional user prompt."""
+    ingredients_dict, ingredients_list, pantry_keys = _load_recommender_pantry(db)
     
-    recommender = RecipeRecommender()
-    service_response = await recommender.get_recipe_recommendations(ingredients_list, user_prompt)
+    cache_key = _recipe_cache_key(ingredients_list, user_prompt)
+    service_response = recipe_cache.get(cache_key)
+    if service_response is None:
+        service_response = await recipe_recommender.get_recipe_recommendations(ingredients_list, user_prompt)
+        if not service_response.get("error"):
+            recipe_cache.set(cache_key, service_response)
     
     # Check if the response is a direct chat message or an error from the service
     if "chat_response" in service_response:
@@ -165,46 +304,9 @@ async def get_recipe_recommendations(
     # Filter recipes to only include ingredients we have and adjust quantities
     filtered_recommendations = []
     for recipe in recipes:
-        # Ensure recipe is a dictionary
-        if not isinstance(recipe, dict):
-            continue
-            
-        available_ingredients = []
-        can_make_recipe = True
-        missing_ingredients = []  # Track missing ingredients for debugging
-        
-        # Ensure recipe has ingredients
-        if not isinstance(recipe.get("ingredients"), list):
-            continue
-            
-        for ingredient in recipe["ingredients"]:
-            # Ensure ingredient is a dictionary
-            if not isinstance(ingredient, dict):
-                continue
-                
-            item_name = ingredient.get("name", "").lower()
-            if not item_name:
-                continue
-                
-            # Skip if it's a common ingredient
-            if item_name in common_ingredients:
-                continue
-                
-            if item_name in ingredients_dict:
-                available = ingredients_dict[item_name]
-                # Only include ingredients we have and adjust quantity to what's available
-                available_ingredients.append({
-                    "name": ingredient["name"],
-                    "quantity": min(ingredient.get("quantity", 0), available["quantity"]),
-                    "unit": ingredient.get("unit", available["unit"])
-                })
-            else:
-                missing_ingredients.append(item_name)
-                
-        
-        if can_make_recipe and available_ingredients:
-            recipe["ingredients"] = available_ingredients
-            filtered_recommendations.append(recipe)
+        filtered = _filter_recipe(recipe, ingredients_dict, pantry_keys)
+        if filtered is not None:
+            filtered_recommendations.append(filtered)
     
     if not filtered_recommendations:
         raise HTTPException(
@@ -214,6 +316,65 @@ async def get_recipe_recommendations(
     
     return filtered_recommendations
 
+@app.get("/recipes/recommend/stream")
+async def stream_recipe_recommendations(
+    user_prompt: str = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Stream recipe recommendations as newline-delimited JSON, one line per recipe as soon as it is generated.
+    Each line is {"recipe": {...}}, {"message": "..."} for a chat reply, or {"error": "..."}.
+    """
+    ingredients_dict, ingredients_list, pantry_keys = _load_recommender_pantry(db)
+    cache_key = _recipe_cache_key(ingredients_list, user_prompt)
+
+    async def service_events():
+        cached = recipe_cache.get(cache_key)
+        if cached is not None:
+            if "chat_response" in cached:
+                yield cached
+            else:
+                for recipe in cached.get("recipes", []):
+                    yield {"recipe": recipe}
+            return
+        
+        recipes = []
+        async for event in recipe_recommender.stream_recipe_recommendations(ingredients_list, user_prompt):
+            if "recipe" in event:
+                recipes.append(event["recipe"])
+            elif event.get("error"):
+                yield event
+                return  # Don't cache a partial list of recipes
+            else:
+                recipe_cache.set(cache_key, event)
+            yield event
+        if recipes:
+            recipe_cache.set(cache_key, {"recipes": recipes})
+
+    async def ndjson_lines():
+        recipes_sent = 0
+        async for event in service_events():
+            if "recipe" in event:
+                filtered = _filter_recipe(event["recipe"], ingredients_dict, pantry_keys)
+                if filtered is None:
+                    continue
+                recipes_sent += 1
+                line = {"recipe": filtered}
+            elif event.get("error"):
+                line = {"error": event["chat_response"]}
+            else:
+                line = {"message": event["chat_response"]}
+            yield orjson.dumps(line) + b"\n"
+            if "recipe" not in line:
+                return
+        
+        if not recipes_sent:
+            yield orjson.dumps({
+                "error": "No recipes found that can be made with your current pantry items. Try adding more ingredients or adjusting your search."
+            }) + b"\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
 @app.post("/recipes/use/")
 async def use_recipe(recipe: Dict, db: Session = Depends(get_db)):
     """
@@ -221,8 +382,13 @@ async def use_recipe(recipe: Dict, db: Session = Depends(get_db)):
     Only uses available ingredients and quantities.
     Moves zero-quantity items to the to_buy list.
     """
-    # Get all ingredients from the database
-    ingredients = db.query(models.Ingredient).all()
+    recipe_ingredients = recipe.get("ingredients", [])
+    
+    # Fetch only the pantry rows this recipe uses, in a single query
+    name_set = {item["name"].lower() for item in recipe_ingredients}
+    ingredients = db.scalars(
+        select(models.Ingredient).where(func.lower(models.Ingredient.name).in_(name_set))
+    ) if name_set else []
     
     # Convert to dictionary format for easier lookup
     ingredients_dict = {
@@ -236,16 +402,17 @@ async def use_recipe(recipe: Dict, db: Session = Depends(get_db)):
         for ing in ingredients
     }
     
-    # Track items that need to be updated
-    items_to_update = []
+    # Track items that need to be updated, keyed by ingredient id
+    items_to_update = {}
+    items_to_delete = []
     items_to_buy = []
     
     # Process each ingredient in the recipe
-    for item in recipe.get("ingredients", []):
+    for item in recipe_ingredients:
         item_name = item["name"].lower()
         required_quantity = item["quantity"]
         
-        # Only process ingredients we have in the pantry
+        # Only process ingredients we still have in the pantry
         if item_name in ingredients_dict:
             available = ingredients_dict[item_name]
             
@@ -255,7 +422,7 @@ async def use_recipe(recipe: Dict, db: Session = Depends(get_db)):
             if remaining_quantity <= 0:
                 # Add to to_buy list only if we had the item and used it all
                 items_to_buy.append({
-                    "name": item["name"],
+                    "name": item_name,
                     "quantity": abs(remaining_quantity),
                     "unit": item["unit"],
                     "category": available["category"],
@@ -263,36 +430,40 @@ async def use_recipe(recipe: Dict, db: Session = Depends(get_db)):
                 })
                 
                 # Remove from pantry
-                db.query(models.Ingredient).filter(
-                    models.Ingredient.id == available["id"]
-                ).delete()
+                items_to_update.pop(available["id"], None)
+                items_to_delete.append(available["id"])
+                del ingredients_dict[item_name]
             else:
                 # Update quantity in pantry
-                items_to_update.append({
+                available["quantity"] = remaining_quantity
+                items_to_update[available["id"]] = {
                     "id": available["id"],
                     "quantity": remaining_quantity
-                })
+                }
     
-    # Update pantry quantities
-    for item in items_to_update:
-        db.query(models.Ingredient).filter(
-            models.Ingredient.id == item["id"]
-        ).update({"quantity": item["quantity"]})
+    # Update pantry quantities and remove used-up items, one statement each
+    if items_to_update:
+        db.execute(
+            update(models.Ingredient),
+            list(items_to_update.values()),
+            execution_options={"synchronize_session": False}
+        )
+    if items_to_delete:
+        db.execute(
+            delete(models.Ingredient).where(models.Ingredient.id.in_(items_to_delete)),
+            execution_options={"synchronize_session": False}
+        )
     
-    # Add items to to_buy list
-    for item in items_to_buy:
-        existing_item = db.query(models.ToBuy).filter(
-            models.ToBuy.name == item["name"]
-        ).first()
-        
-        if existing_item:
-            # Update existing item
-            existing_item.quantity = max(existing_item.quantity, item["quantity"])
-            existing_item.last_used = item["last_used"]
-        else:
-            # Create new item
-            to_buy_item = models.ToBuy(**item)
-            db.add(to_buy_item)
+    # Merge items into the to_buy list, keeping the larger quantity on conflict
+    if items_to_buy:
+        stmt = sqlite_insert(models.ToBuy).values(items_to_buy)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[func.lower(models.ToBuy.name)],
+            set_={
+                "quantity": func.max(models.ToBuy.quantity, stmt.excluded.quantity),
+                "last_used": stmt.excluded.last_used
+            }
+        ))
     
     db.commit()
     
@@ -304,9 +475,17 @@ async def use_recipe(recipe: Dict, db: Session = Depends(get_db)):
 
 # Pantry Management Endpoints
 @app.get("/pantry/", response_model=List[schemas.Ingredient])
-def view_pantry(db: Session = Depends(get_db)):
+def view_pantry(request: Request, response: Response, db: Session = Depends(get_db)):
     """View all ingredients in the pantry."""
-    return db.query(models.Ingredient).all()
+    rows = db.execute(select(models.Ingredient.__table__)).all()
+    
+    # Let polling clients revalidate instead of downloading an unchanged pantry
+    etag = _rows_etag(rows)
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return rows
 
 @app.post("/pantry/add/", response_model=schemas.Ingredient)
 def add_to_pantry(ingredient: schemas.IngredientCreate, db: Session = Depends(get_db)):
@@ -314,71 +493,40 @@ def add_to_pantry(ingredient: schemas.IngredientCreate, db: Session = Depends(ge
     # Round quantity to nearest whole number
     rounded_quantity = round(ingredient.quantity)
     
-    # Check if ingredient already exists
-    existing_ingredient = db.query(models.Ingredient).filter(
-        models.Ingredient.name == ingredient.name
-    ).first()
-    
-    if existing_ingredient:
-        # Add to existing quantity and round
-        new_quantity = round(existing_ingredient.quantity + rounded_quantity)
-        
-        # If quantity is less than 0.5, move to to_buy list
-        if new_quantity < 0.5:
-            # Add to to_buy list
-            to_buy_item = db.query(models.ToBuy).filter(
-                models.ToBuy.name == ingredient.name
-            ).first()
-            
-            if to_buy_item:
-                # Update existing to_buy item
-                to_buy_item.quantity = max(to_buy_item.quantity, 1)  # At least 1 unit
-            else:
-                # Create new to_buy item
-                to_buy_item = models.ToBuy(
-                    name=ingredient.name,
-                    quantity=1,  # At least 1 unit
-                    unit=ingredient.unit,
-                    category=ingredient.category,
-                    last_used="Low quantity alert"
-                )
-                db.add(to_buy_item)
-            
-            # Remove from pantry
-            db.delete(existing_ingredient)
-        else:
-            existing_ingredient.quantity = new_quantity
-        
-        db.commit()
-        if new_quantity >= 0.5:
-            db.refresh(existing_ingredient)
-            return existing_ingredient
-        return None
+    # Insert the ingredient, or add to the existing quantity and round, in one statement
+    stmt = sqlite_insert(models.Ingredient).values(
+        name=ingredient.name.lower(),
+        quantity=rounded_quantity,
+        unit=ingredient.unit,
+        category=ingredient.category,
+        min_quantity=round(ingredient.min_quantity or rounded_quantity * 0.2)  # Use specified min_quantity or calculate it
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[func.lower(models.Ingredient.name)],
+        set_={"quantity": func.round(models.Ingredient.quantity + stmt.excluded.quantity)}
+    ).returning(models.Ingredient)
+    db_ingredient = db.scalars(stmt).one()
     
-    # For new ingredients, if quantity is less than 0.5, add directly to to_buy list
-    if rounded_quantity < 0.5:
-        to_buy_item = models.ToBuy(
-            name=ingredient.name,
+    # If quantity is less than 0.5, move to to_buy list
+    if db_ingredient.quantity < 0.5:
+        to_buy_stmt = sqlite_insert(models.ToBuy).values(
+            name=ingredient.name.lower(),
             quantity=1,  # At least 1 unit
             unit=ingredient.unit,
             category=ingredient.category,
             last_used="Low quantity alert"
         )
-        db.add(to_buy_item)
+        db.execute(to_buy_stmt.on_conflict_do_update(
+            index_elements=[func.lower(models.ToBuy.name)],
+            set_={"quantity": func.max(models.ToBuy.quantity, 1)}  # At least 1 unit
+        ))
+        
+        # Remove from pantry
+        db.delete(db_ingredient)
         db.commit()
         return None
     
-    # Create new ingredient with rounded quantity
-    db_ingredient = models.Ingredient(
-        name=ingredient.name,
-        quantity=rounded_quantity,
-        unit=ingredient.unit,
-        category=ingredient.category,
-        min_quantity=round(ingredient.min_quantity if ingredient.min_quantity else rounded_quantity * 0.2)  # Use specified min_quantity or calculate it
-    )
-    db.add(db_ingredient)
     db.commit()
-    db.refresh(db_ingredient)
     return db_ingredient
 
 @app.delete("/pantry/{item_id}")
@@ -414,31 +562,34 @@ def clear_pantry(confirm: bool = False, db: Session = Depends(get_db)):
 
 # To-Buy List Management Endpoints
 @app.get("/to-buy/", response_model=List[schemas.ToBuy])
-def view_to_buy(db: Session = Depends(get_db)):
+def view_to_buy(request: Request, response: Response, db: Session = Depends(get_db)):
     """View all items in the to-buy list."""
-    return db.query(models.ToBuy).all()
+    rows = db.execute(select(models.ToBuy.__table__)).all()
+    
+    # Let polling clients revalidate instead of downloading an unchanged list
+    etag = _rows_etag(rows)
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return rows
 
 @app.post("/to-buy/add/", response_model=schemas.ToBuy)
 def add_to_buy_list(item: schemas.ToBuyCreate, db: Session = Depends(get_db)):
     """Manually add an item to the to-buy list."""
-    # Check if item already exists
-    existing_item = db.query(models.ToBuy).filter(
-        models.ToBuy.name == item.name
-    ).first()
-    
-    if existing_item:
-        # Update existing item
-        existing_item.quantity += item.quantity
-        existing_item.last_used = item.last_used
-        db.commit()
-        db.refresh(existing_item)
-        return existing_item
-    
-    # Create new item
-    db_item = models.ToBuy(**item.dict())
-    db.add(db_item)
+    # Insert the item, or add to the existing quantity, in one statement
+    item_data = item.model_dump()
+    item_data["name"] = item.name.lower()
+    stmt = sqlite_insert(models.ToBuy).values(**item_data)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[func.lower(models.ToBuy.name)],
+        set_={
+            "quantity": models.ToBuy.quantity + stmt.excluded.quantity,
+            "last_used": stmt.excluded.last_used
+        }
+    ).returning(models.ToBuy)
+    db_item = db.scalars(stmt).one()
     db.commit()
-    db.refresh(db_item)
     return db_item
 
 @app.delete("/to-buy/{item_id}")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Table, Index, func
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -23,6 +23,9 @@ class Ingredient(Base):
     category = Column(String)  # e.g., "pantry", "spice", "dairy"
     recipes = relationship("Recipe", secondary=recipe_ingredients, back_populates="ingredients")
 
+# Names are stored lowercase; these also serve the case-insensitive lookups and upserts
+Index("ix_ingredients_lower_name", func.lower(Ingredient.name), unique=True)
+
 class ToBuy(Base):
     __tablename__ = "to_buy"
 
@@ -33,6 +36,8 @@ class ToBuy(Base):
     category = Column(String)
     last_used = Column(String)  # Recipe name where it was last used
 
+Index("ix_to_buy_lower_name", func.lower(ToBuy.name), unique=True)
+
 class Recipe(Base):
     __tablename__ = "recipes"
 
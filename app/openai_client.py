@@ -0,0 +1,47 @@
+import logging
+import os
+import httpx
+from dotenv import load_dotenv
+
+# Try to load the OpenAI SDK, with graceful fallback if missing
+try:
+    from openai import AsyncOpenAI
+except ImportError:
+    AsyncOpenAI = None
+
+# HTTP/2 needs the optional h2 package, fall back to HTTP/1.1 keep-alive without it
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Load environment variables
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+# One connection pool for every OpenAI call in the app, so TLS handshakes and
+# keep-alive connections are reused across requests and services. Over HTTP/2,
+# concurrent calls also multiplex on the same connection
+http_client = httpx.AsyncClient(
+    http2=HTTP2_AVAILABLE,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+    timeout=httpx.Timeout(120.0, connect=10.0)
+)
+
+def _create_client() -> "AsyncOpenAI | None":
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key or AsyncOpenAI is None:
+        return None
+    try:
+        return AsyncOpenAI(api_key=api_key, http_client=http_client)
+    except Exception as e:
+        log.warning("Failed to initialize shared OpenAI AsyncClient: %s", e)
+        return None
+
+client = _create_client()
+
+async def aclose() -> None:
+    """Close the shared connection pool, called when the app shuts down."""
+    await http_client.aclose()
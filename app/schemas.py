@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, ConfigDict
+from typing import List, Optional, Dict, Any
 
 class IngredientBase(BaseModel):
     name: str
@@ -8,14 +8,19 @@ class IngredientBase(BaseModel):
     category: str
 
 class IngredientCreate(IngredientBase):
-    pass
+    min_quantity: Optional[float] = None
 
 class Ingredient(IngredientBase):
     id: int
     min_quantity: float
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
+
+class ReceiptUploadResponse(BaseModel):
+    message: str
+    items_added: int
+    items: List[Ingredient]
+    debug: Dict[str, Any]
 
 class ToBuyBase(BaseModel):
     name: str
@@ -30,8 +35,7 @@ class ToBuyCreate(ToBuyBase):
 class ToBuy(ToBuyBase):
     id: int
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class RecipeBase(BaseModel):
     name: str
@@ -45,8 +49,7 @@ class Recipe(RecipeBase):
     id: int
     ingredients: List[Ingredient]
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class RecipeRecommendation(BaseModel):
     recipe: Recipe
@@ -0,0 +1,48 @@
+import json
+from typing import Any, List
+
+_SKIP_CHARS = " \t\r\n,"
+
+
+class ArrayItemDecoder:
+    """Incrementally decode the elements of the first JSON array in streamed text.
+
+    Model responses arrive a few characters at a time. Each call to feed()
+    returns the array elements completed by that chunk, so callers can start
+    working on them before the rest of the response has been generated.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._in_array = False
+        self.done = False
+
+    def feed(self, chunk: str) -> List[Any]:
+        self._buffer += chunk
+        items = []
+        if not self._in_array:
+            start = self._buffer.find("[")
+            if start < 0:
+                return items
+            self._buffer = self._buffer[start + 1:]
+            self._in_array = True
+
+        while not self.done:
+            pos = 0
+            while pos < len(self._buffer) and self._buffer[pos] in _SKIP_CHARS:
+                pos += 1
+            if pos >= len(self._buffer):
+                break
+            if self._buffer[pos] == "]":
+                self.done = True
+                break
+            try:
+                item, end = self._decoder.raw_decode(self._buffer, pos)
+            except json.JSONDecodeError:
+                break  # Element is still incomplete, wait for more text
+            if end == len(self._buffer) and not isinstance(item, (dict, list, str)):
+                break  # A number or literal at the very end may still be growing
+            items.append(item)
+            self._buffer = self._buffer[end:]
+        return items
@@ -1,13 +1,20 @@
 import pytesseract
 from PIL import Image
 import io
-from typing import List, Dict
+import numpy as np
+from typing import List, Dict, BinaryIO
+import logging
 import os
 import re
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-import json
+from fastapi.concurrency import run_in_threadpool
+import orjson
 import base64
+import hashlib
+
+from ..openai_client import client as openai_client
+from .ttl_cache import TTLCache
 
 # Try to load LLM dependencies, with graceful fallback if missing
 try:
@@ -21,6 +28,66 @@ except ImportError:
 # Load environment variables
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
+# Parsed items are cached by image content so re-uploads of the same receipt skip the vision call
+RECEIPT_CACHE_MAX_ENTRIES = 256
+RECEIPT_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# JPEG uploads up to this size are sent to the vision model as-is instead of being re-encoded
+JPEG_PASSTHROUGH_MAX_BYTES = 4 * 1024 * 1024
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# The prompt is identical for every receipt so OpenAI's prompt caching can reuse the prefix;
+# only the image part of the user message changes per call
+_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": """You are a receipt analyzer specialized in processing grocery receipts.
+    Your task is to extract grocery items as accurately as possible, including:
+
+    1. Item name (generic product name, remove brand names)
+    2. Quantity (numeric value, default to 1.0 if no quantity is specified)
+    3. Unit of measurement (e.g., can, bottle, lb, oz, package, item)
+    4. Category (pantry, dairy, produce, meat, bakery, other)
+
+    Standardize item names by removing brand names and using common terms:
+    - "HEINZ KETCHUP" → "ketchup"
+    - "COUNTRY HARVEST BREAD" → "wheat bread"
+    - "JIF PEANUT BUTTER" → "peanut butter"
+
+    Focus only on food items and ignore:
+    - Store information, dates, receipt numbers
+    - Prices, totals, subtotals, taxes
+    - Discounts, loyalty information
+    - Non-food items
+
+    Return ONLY a valid JSON array of items.
+    """
+}
+
+_USER_TEXT_CONTENT = {
+    "type": "text",
+    "text": """Analyze this receipt image and extract only the grocery items.
+    The image may be a receipt from a grocery store.
+
+    Return ONLY a JSON array of items with this exact format:
+    [
+        {
+            "name": "item name",
+            "quantity": 1.0,
+            "unit": "unit",
+            "category": "category"
+        },
+        ...
+    ]
+    If no items are found or the image is not a receipt, return an empty array [].
+    Ensure all fields (name, quantity, unit, category) are present for each item.
+    Default quantity to 1.0 if not specified.
+    Default unit to 'item' if not specified.
+    Try to infer category, or use 'other' if unsure.
+    """
+}
+
 # Add the ReceiptItem class back for compatibility with recipe_recommender.py
 class ReceiptItem(BaseModel):
     name: str = Field(description="Name of the grocery item")
@@ -32,111 +99,121 @@ class ReceiptProcessor:
     def __init__(self):
         self.client: AsyncOpenAI | None = None
         self.can_process = False
+        self._cache = TTLCache(RECEIPT_CACHE_MAX_ENTRIES, RECEIPT_CACHE_TTL_SECONDS)
+        # Set RECEIPT_ENHANCE_JPEG=true to run the contrast pass on JPEG uploads as well
+        self.enhance_jpeg = os.getenv("RECEIPT_ENHANCE_JPEG", "false").lower() == "true"
         
         api_key = os.getenv("OPENAI_API_KEY")
         if api_key and HAS_LLM_DEPS and AsyncOpenAI is not None:
-            try:
-                self.client = AsyncOpenAI(api_key=api_key)
+            # Reuse the app-wide client and its warm connection pool
+            if openai_client is not None:
+                self.client = openai_client
                 self.can_process = True
-            except Exception as e:
-                print(f"Failed to initialize OpenAI AsyncClient: {e}. Receipt processing will not be available.")
+            else:
+                log.warning("Failed to initialize OpenAI AsyncClient. Receipt processing will not be available.")
                 self.can_process = False
         else:
             if not api_key:
-                print("OPENAI_API_KEY not found. Receipt processing will not be available.")
+                log.warning("OPENAI_API_KEY not found. Receipt processing will not be available.")
             if not HAS_LLM_DEPS or AsyncOpenAI is None:
-                print("OpenAI dependencies (including async support) not installed or import failed. Receipt processing will not be available.")
+                log.warning("OpenAI dependencies (including async support) not installed or import failed. Receipt processing will not be available.")
             self.can_process = False
 
     def _encode_image_to_base64(self, image_data: bytes) -> str:
         """Encode image to base64 for OpenAI vision model."""
         return base64.b64encode(image_data).decode('utf-8')
 
-    async def process_receipt_image(self, image_data: bytes) -> List[Dict]:
-        """Process a receipt image to extract grocery items using the OpenAI vision model."""
+    def _hash_image(self, image_file: BinaryIO) -> str:
+        """Hash the image content in chunks and rewind the file for decoding."""
+        digest = hashlib.blake2b(digest_size=16)
+        for chunk in iter(lambda: image_file.read(1 << 16), b""):
+            digest.update(chunk)
+        image_file.seek(0)
+        return digest.hexdigest()
+
+    async def process_receipt_image(self, image_file: BinaryIO) -> List[Dict]:
+        """Process a receipt image file to extract grocery items using the OpenAI vision model."""
         if not self.can_process or not self.client:
-            print("Receipt processor is not initialized or OpenAI client is not available.")
+            log.error("Receipt processor is not initialized or OpenAI client is not available.")
             return []
 
         try:
-            items = await self._process_with_vision(image_data)
+            key = await run_in_threadpool(self._hash_image, image_file)
+            cached_items = self._cache.get(key)
+            if cached_items is not None:
+                return list(cached_items)
+
+            items = await self._process_with_vision(image_file)
+            # Empty results usually mean the call failed, so only cache successful parses
+            if items:
+                self._cache.set(key, list(items))
             
             return items
         except Exception as e:
-            print(f"Error processing receipt image with vision model: {e}")
+            log.exception("Error processing receipt image with vision model: %s", e)
+            return []
+
+    def _parse_items(self, raw_response_content: str) -> List[Dict]:
+        """Extract the items list from a complete JSON response."""
+        try:
+            parsed_json = orjson.loads(raw_response_content)
+            if isinstance(parsed_json, list):
+                return parsed_json
+            if isinstance(parsed_json, dict) and "items" in parsed_json and isinstance(parsed_json["items"], list):
+                return parsed_json["items"]
+            log.warning("Unexpected JSON structure from OpenAI: %s", parsed_json)
+            for value in parsed_json.values():
+                if isinstance(value, list):
+                    return value
+            log.warning("Could not extract items from the JSON response.")
+            return []
+        except orjson.JSONDecodeError as e:
+            log.error("Error decoding JSON from OpenAI: %s", e)
+            log.debug("Raw response content was: %s", raw_response_content)
             return []
 
-    async def _process_with_vision(self, image_data: bytes) -> List[Dict]:
+    def _preprocess(self, image_file: BinaryIO) -> str:
+        """Prepare the receipt image for the vision model and return it as base64 JPEG."""
+        if not self.enhance_jpeg:
+            is_jpeg = image_file.read(len(JPEG_MAGIC)) == JPEG_MAGIC
+            size = image_file.seek(0, io.SEEK_END)
+            image_file.seek(0)
+            if is_jpeg and size <= JPEG_PASSTHROUGH_MAX_BYTES:
+                # Already compressed, so skip the decode/encode round-trip entirely
+                return self._encode_image_to_base64(image_file.read())
+        
+        # Decode straight from the file object so the upload is never copied into memory
+        image = Image.open(image_file)
+        pixels = np.asarray(image.convert('L'), dtype=np.int16)
+        
+        # Same result as ImageEnhance.Contrast(image).enhance(2.0): push each pixel
+        # twice as far from the mean grey level, done as one vectorized pass
+        mean = int(pixels.mean() + 0.5)
+        pixels = np.clip(pixels * 2 - mean, 0, 255).astype(np.uint8)
+        
+        # Grayscale JPEG is fine for the vision model, so skip the extra RGB conversion
+        image = Image.fromarray(pixels, 'L')
+        
+        processed_img_io = io.BytesIO()
+        image.save(processed_img_io, format='JPEG', quality=95)
+        processed_img_data = processed_img_io.getvalue()
+        
+        return self._encode_image_to_base64(processed_img_data)
+
+    async def _process_with_vision(self, image_file: BinaryIO) -> List[Dict]:
         """Process receipt image using OpenAI vision model with image preprocessing."""
         try:
-            # Use Pillow to preprocess the image for better results
-            from PIL import Image, ImageEnhance
-            import io
-            
-            image = Image.open(io.BytesIO(image_data))
-            image = image.convert('L')
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(2.0)
-            image = image.convert('RGB')
-            
-            processed_img_io = io.BytesIO()
-            image.save(processed_img_io, format='JPEG', quality=95)
-            processed_img_data = processed_img_io.getvalue()
-            
-            base64_image = self._encode_image_to_base64(processed_img_data)
+            # Decoding and re-encoding is CPU-bound, so keep it off the event loop
+            base64_image = await run_in_threadpool(self._preprocess, image_file)
             
             response = await self.client.chat.completions.create(
                 model="gpt-4o-mini", #Good for vision
                 messages=[
-                    {
-                        "role": "system",
-                        "content": """You are a receipt analyzer specialized in processing grocery receipts.
-                        Your task is to extract grocery items as accurately as possible, including:
-                        
-                        1. Item name (generic product name, remove brand names)
-                        2. Quantity (numeric value, default to 1.0 if no quantity is specified)
-                        3. Unit of measurement (e.g., can, bottle, lb, oz, package, item)
-                        4. Category (pantry, dairy, produce, meat, bakery, other)
-                        
-                        Standardize item names by removing brand names and using common terms:
-                        - "HEINZ KETCHUP" → "ketchup"
-                        - "COUNTRY HARVEST BREAD" → "wheat bread"
-                        - "JIF PEANUT BUTTER" → "peanut butter"
-                        
-                        Focus only on food items and ignore:
-                        - Store information, dates, receipt numbers
-                        - Prices, totals, subtotals, taxes
-                        - Discounts, loyalty information
-                        - Non-food items
-                        
-                        Return ONLY a valid JSON array of items.
-                        """
-                    },
+                    _SYSTEM_MESSAGE,
                     {
                         "role": "user",
                         "content": [
-                            {
-                                "type": "text",
-                                "text": """Analyze this receipt image and extract only the grocery items.
-                                The image may be a receipt from a grocery store.
-                                
-                                Return ONLY a JSON array of items with this exact format:
-                                [
-                                    {
-                                        "name": "item name",
-                                        "quantity": 1.0,
-                                        "unit": "unit",
-                                        "category": "category"
-                                    },
-                                    ...
-                                ]
-                                If no items are found or the image is not a receipt, return an empty array [].
-                                Ensure all fields (name, quantity, unit, category) are present for each item.
-                                Default quantity to 1.0 if not specified.
-                                Default unit to 'item' if not specified.
-                                Try to infer category, or use 'other' if unsure.
-                                """
-                            },
+                            _USER_TEXT_CONTENT,
                             {
                                 "type": "image_url",
                                 "image_url": {
@@ -149,46 +226,30 @@ class ReceiptProcessor:
                 response_format={"type": "json_object"}
             )
             
-            raw_response_content = response.choices[0].message.content
+            choice = response.choices[0]
+            raw_response_content = choice.message.content
             if raw_response_content is None:
-                print("OpenAI API returned None content.")
+                log.warning("OpenAI API returned None content.")
+                return []
+            if choice.finish_reason == "length":
+                # A truncated reply would only yield part of the receipt, so treat it as a failure
+                log.warning("OpenAI response was cut off before the item list was complete.")
                 return []
 
-            try:
-                parsed_json = json.loads(raw_response_content)
-                if isinstance(parsed_json, list):
-                    items = parsed_json
-                elif isinstance(parsed_json, dict) and "items" in parsed_json and isinstance(parsed_json["items"], list):
-                    items = parsed_json["items"]
-                else:
-                    print(f"Unexpected JSON structure from OpenAI: {parsed_json}")
-                    found_list = None
-                    for value in parsed_json.values():
-                        if isinstance(value, list):
-                            found_list = value
-                            break
-                    if found_list is not None:
-                        items = found_list
-                    else:
-                        items = []
-                        print("Could not extract items from the JSON response.")
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON from OpenAI: {e}")
-                print(f"Raw response content was: {raw_response_content}")
-                items = []
+            items = self._parse_items(raw_response_content)
             
             validated_items = []
             for item in items:
                 if isinstance(item, dict) and all(k in item for k in ["name", "quantity", "unit", "category"]):
                     validated_items.append(item)
                 else:
-                    print(f"Skipping malformed item: {item}")
+                    log.warning("Skipping malformed item: %s", item)
             
             return validated_items
 
         except openai.APIError as e:
-            print(f"OpenAI API Error: {e}")
+            log.error("OpenAI API Error: %s", e)
             return []
         except Exception as e:
-            print(f"Error in _process_with_vision: {e}")
+            log.exception("Error in _process_with_vision: %s", e)
             return []
@@ -1,250 +1,379 @@
 from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
-from typing import List, Dict, Literal
+from typing import AsyncIterator, List, Dict
+import logging
 import os
 from dotenv import load_dotenv
 # from .receipt_processor import ReceiptItem # This seems unused here
-import json
+import operator
+import orjson
+import re
+from ..openai_client import client as openai_client
+from .json_stream import ArrayItemDecoder
 
 load_dotenv()
 
-UserIntent = Literal["RECIPE_REQUEST", "GENERAL_FOOD_QUESTION", "GENERAL_CHAT", "UNKNOWN_INTENT"]
+log = logging.getLogger(__name__)
+
+# Finds the start of the "recipes" array in a streamed reply. Matching the key itself means
+# brackets inside the message string, which comes first, are never mistaken for the array
+_RECIPES_ARRAY_RE = re.compile(r'"recipes"\s*:\s*\[')
+
+# A single structured-output call decides the intent and answers it: either a
+# conversational reply or a list of recipes, never both
+_RECOMMENDATION_SCHEMA = {
+    "name": "kitchen_assistant_reply",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "enum": ["chat", "recipes"]},
+            "message": {"type": "string"},
+            "recipes": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string"},
+                        "description": {"type": "string"},
+                        "ingredients": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "name": {"type": "string"},
+                                    "quantity": {"type": "number"},
+                                    "unit": {"type": "string"}
+                                },
+                                "required": ["name", "quantity", "unit"],
+                                "additionalProperties": False
+                            }
+                        },
+                        "instructions": {"type": "array", "items": {"type": "string"}},
+                        "cooking_time": {"type": "string"},
+                        "difficulty": {"type": "string", "enum": ["Easy", "Medium", "Hard"]},
+                        "confidence_score": {"type": "number"}
+                    },
+                    "required": [
+                        "name", "description", "ingredients", "instructions",
+                        "cooking_time", "difficulty", "confidence_score"
+                    ],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["type", "message", "recipes"],
+        "additionalProperties": False
+    }
+}
+
+# Usage confirmations return every pantry item with its remaining quantity, one list per recipe
+_USAGE_SCHEMA = {
+    "name": "remaining_ingredients",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "recipe_index": {"type": "integer"},
+                        "remaining_ingredients": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "name": {"type": "string"},
+                                    "quantity": {"type": "number"},
+                                    "unit": {"type": ["string", "null"]},
+                                    "category": {"type": ["string", "null"]}
+                                },
+                                "required": ["name", "quantity", "unit", "category"],
+                                "additionalProperties": False
+                            }
+                        }
+                    },
+                    "required": ["recipe_index", "remaining_ingredients"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["results"],
+        "additionalProperties": False
+    }
+}
+
+# An empty prompt is treated as a greeting, the model will answer it conversationally
+_DEFAULT_USER_PROMPT = "Hello"
+
+_EMPTY_PANTRY_MESSAGE = "Your pantry looks empty. Add some ingredients and I'll suggest recipes!"
+
+_RECOMMENDATION_ERROR_MESSAGE = "I encountered an issue trying to find recipes or answer your food question. Please try again."
+
+# Used instead when the model did reply, so the raw text is shown for troubleshooting
+_RAW_RESPONSE_ERROR_MESSAGE = "An error occurred with recipes. Raw AI response: {}"
+
+_RECIPE_SYSTEM_PROMPT = """You are a helpful and friendly cooking and kitchen assistant.
+First decide what the user wants:
+- Recipes, meal ideas, what to cook, or how to prepare a dish: "type" is "recipes", fill "recipes", leave "message" empty.
+- Greetings, small talk, general food or cooking questions, or follow-ups that need no new recipe: "type" is "chat", \
+reply briefly and kindly in "message", leave "recipes" empty. Gently steer off-topic questions back to food.
+
+Recipe guidelines:
+1. Prioritize recipes that match the request and use the available ingredients; suggest diverse, practical ones if it is vague.
+2. List common staples (salt, pepper, oil, basic spices) only if the recipe needs them.
+3. Use no more of a pantry ingredient than the recipe needs.
+4. If a requested recipe can't be made, say what's missing or suggest alternatives.
+5. Give clear, step-by-step instructions and a readable "cooking_time" such as "20-25 minutes".
+6. "confidence_score" (0.0-1.0) is how well the recipe fits the pantry and the request."""
+
+_USAGE_SYSTEM_PROMPT = """You are a helpful cooking assistant that helps track ingredient usage.
+For each numbered recipe, calculate the remaining quantities of ingredients after using that recipe.
+Each recipe is calculated separately against the same available ingredients.
+Consider:
+1. Subtract used quantities from available quantities
+2. Handle unit conversions if necessary (though the input units should generally be consistent)
+3. Return 0 for ingredients that are completely used
+4. Keep track of ingredients that weren't used in the recipe (these should be returned with their original quantities)
+5. If there is an extra ingredient in the recipe that is not from available ingredients, ignore it for calculation purposes.
+
+Return one result per recipe, with "recipe_index" set to the number shown in brackets before the recipe. \
+Pass each ingredient's category through unchanged from the available ingredients.
+Each 'remaining_ingredients' list must include ALL ingredients from the original \
+'available_ingredients' list, updating quantities for those used, and keeping original quantities for those not used."""
+
+_USAGE_USER_PROMPT = """Available ingredients (with categories):
+{available_text_input}
+
+Recipes to prepare:
+{recipes_text_input}
+
+Calculate remaining ingredients after preparing each recipe.
+Return one result per recipe, each with ALL original ingredients and updated quantities for used ones.
+Preserve the category for each ingredient as provided in the available list."""
+
+_PANTRY_LINE_FIELDS = operator.itemgetter("name", "quantity", "unit")
+
+def _resolve_user_prompt(available_ingredients: List[Dict], user_prompt: str | None) -> str | None:
+    """Return the prompt to send to the model, or None when there is nothing to cook with and nothing asked."""
+    if user_prompt and user_prompt.strip():
+        return user_prompt
+    if not available_ingredients:
+        return None
+    return _DEFAULT_USER_PROMPT
+
+def _format_pantry(ingredients: List[Dict]) -> str:
+    # One "- name: quantity unit" line per ingredient, as shown to the model
+    return "\n".join("- %s: %s %s" % _PANTRY_LINE_FIELDS(ing) for ing in ingredients)
+
+def _subtract_locally(recipe: Dict, available_ingredients: List[Dict]):
+    """Subtract a recipe's ingredients from the pantry with plain arithmetic.
+
+    Returns the remaining ingredients (every pantry item, used or not) and the recipe
+    ingredients whose unit differs from the pantry's or whose quantity isn't a plain
+    number (e.g. "1/2"), which are left unchanged here.
+    Recipe ingredients that aren't in the pantry are ignored.
+    """
+    used = {}
+    conflicts = []
+    pantry_units = {ing["name"].lower(): (ing["unit"] or "").lower() for ing in available_ingredients}
+    for ingredient in recipe.get("ingredients", []):
+        name = ingredient.get("name", "").lower()
+        if name not in pantry_units:
+            continue
+        if (ingredient.get("unit") or "").lower() != pantry_units[name]:
+            conflicts.append(ingredient)
+            continue
+        try:
+            quantity = float(ingredient.get("quantity") or 0)
+        except (TypeError, ValueError):
+            conflicts.append(ingredient)
+            continue
+        used[name] = used.get(name, 0) + quantity
+
+    remaining = [
+        {
+            "name": ing["name"],
+            "quantity": max(ing["quantity"] - used.get(ing["name"].lower(), 0), 0),
+            "unit": ing["unit"],
+            "category": ing["category"]
+        }
+        for ing in available_ingredients
+    ]
+    return remaining, conflicts
 
 class RecipeRecommender:
     def __init__(self):
-        # Main LLM for recipe generation and more creative/detailed responses
+        # Both models share the app-wide OpenAI client and its connection pool
+        async_client = openai_client.chat.completions if openai_client else None
+        # Main LLM for recipe generation and chat replies, constrained to the reply schema
         self.llm_creative = ChatOpenAI(
             model="o4-mini-2025-04-16",
             temperature=1,
-            api_key=os.getenv("OPENAI_API_KEY")
+            api_key=os.getenv("OPENAI_API_KEY"),
+            async_client=async_client,
+            model_kwargs={"response_format": {"type": "json_schema", "json_schema": _RECOMMENDATION_SCHEMA}}
         )
-        # LLM for classification and more direct/factual chat
+        # LLM for more direct/factual tasks such as ingredient bookkeeping, constrained to the usage schema
         self.llm_direct = ChatOpenAI(
             model="gpt-4.1-nano-2025-04-14", 
             temperature=0.3, 
-            api_key=os.getenv("OPENAI_API_KEY")
+            api_key=os.getenv("OPENAI_API_KEY"),
+            async_client=async_client,
+            model_kwargs={"response_format": {"type": "json_schema", "json_schema": _USAGE_SCHEMA}}
         )
 
-    async def _get_user_intent(self, user_prompt: str) -> UserIntent:
-        if not user_prompt or user_prompt.strip() == "":
-            return "GENERAL_CHAT" # Treat empty prompt as general chat / greeting
-
-        # Create the prompt template with user_prompt as an input variable for clarity
-        intent_prompt_template = ChatPromptTemplate.from_messages([
-            ("system", """You are an intent classifier for a kitchen assistant chatbot.
-            Analyze the user's message and classify it into one of the following categories:
-            - RECIPE_REQUEST: If the user is asking for recipes, meal ideas, what to cook with ingredients, or how to prepare something.
-            - GENERAL_FOOD_QUESTION: If the user is asking about cooking techniques, ingredient properties, substitutions, food storage, food safety, or other general food-related advice that isn\'t a direct recipe request.
-            - GENERAL_CHAT: If the user is making a simple greeting, engaging in small talk, or asking a question clearly unrelated to food, cooking, or recipes.
-
-            Respond with ONLY one of the following category strings: RECIPE_REQUEST, GENERAL_FOOD_QUESTION, or GENERAL_CHAT.
-            Do not add any other text or explanation.
-            Example User: Hi there!
-            Example Assistant: GENERAL_CHAT
-            Example User: What can I make with chicken and rice?
-            Example Assistant: RECIPE_REQUEST
-            Example User: How do I store avocados?
-            Example Assistant: GENERAL_FOOD_QUESTION
-            """),
-            ("user", "{user_input}") # Use a named input variable
+        # Prompt templates are parsed once here rather than on every request. Everything static
+        # lives in the system message so it forms a stable prefix that OpenAI can cache across
+        # requests; only the pantry and request vary, and they come last
+        self._recipe_tmpl = ChatPromptTemplate.from_messages([
+            ("system", _RECIPE_SYSTEM_PROMPT),
+            ("user", "Available ingredients in pantry:\n{pantry_text}"),
+            ("user", 'User\'s request: "{user_request}"')
         ])
-        
-        try:
-            # Format the prompt with the actual user input
-            formatted_prompt = intent_prompt_template.format_prompt(user_input=user_prompt)
-            # Convert to a list of messages for ainvoke
-            messages = formatted_prompt.to_messages()
-            response = await self.llm_direct.ainvoke(messages)
-            content = response.content.strip()
-            
-            if content in ["RECIPE_REQUEST", "GENERAL_FOOD_QUESTION", "GENERAL_CHAT"]:
-                return content
-            print(f"Unexpected intent classification: {content} for prompt: {user_prompt}") # Log unexpected output
-            return "UNKNOWN_INTENT"
-        except Exception as e:
-            print(f"Error in _get_user_intent: {e}")
-            return "UNKNOWN_INTENT"
-
-    async def _handle_general_response(self, user_prompt: str, intent: UserIntent) -> Dict:
-        system_message_content = "You are a friendly and helpful kitchen assistant. Respond conversationally to the user."
-        if intent == "GENERAL_CHAT":
-            system_message_content = "You are a friendly and helpful kitchen assistant. The user might be making small talk or asking a general question. Respond conversationally. If the question is very off-topic from kitchen/food, you can gently guide back or answer briefly."
-        elif intent == "GENERAL_FOOD_QUESTION":
-            system_message_content = "You are a knowledgeable and helpful kitchen assistant. The user has a general question about food or cooking. Provide a clear, concise, and informative answer."
-
-        chat_prompt_template = ChatPromptTemplate.from_messages([
-            ("system", system_message_content),
-            ("user", "{user_input}")
+
+        self._usage_tmpl = ChatPromptTemplate.from_messages([
+            ("system", _USAGE_SYSTEM_PROMPT),
+            ("user", _USAGE_USER_PROMPT)
         ])
+
+    def _build_recipe_messages(self, available_ingredients: List[Dict], current_user_prompt: str) -> List:
+        return self._recipe_tmpl.format_messages(
+            pantry_text=_format_pantry(available_ingredients),
+            user_request=current_user_prompt
+        )
+
+    def _parse_reply(self, content: str) -> Dict:
         try:
-            formatted_prompt = chat_prompt_template.format_prompt(user_input=user_prompt)
-            messages = formatted_prompt.to_messages()
-            response = await self.llm_direct.ainvoke(messages)
-            return {"chat_response": response.content.strip()}
-        except Exception as e:
-            print(f"Error in _handle_general_response: {e}")
-            return {"chat_response": "I had a little trouble thinking about that. Could you try asking differently?", "error": True}
+            parsed_json = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # Only possible if the model refused the schema; pass its text through as chat
+            return {"chat_response": content}
 
-    async def get_recipe_recommendations(self, available_ingredients: List[Dict], user_prompt: str = None) -> Dict:
-        # Ensure user_prompt is not None for intent detection, provide a default if it is.
-        current_user_prompt = user_prompt if user_prompt and user_prompt.strip() else "Hello"
-        user_intent = await self._get_user_intent(current_user_prompt)
-
-        if user_intent == "GENERAL_CHAT" or user_intent == "GENERAL_FOOD_QUESTION":
-            return await self._handle_general_response(current_user_prompt, user_intent)
-        
-        if user_intent == "UNKNOWN_INTENT":
-            print(f"Unknown intent for prompt: '{current_user_prompt}'. Proceeding with recipe search as fallback.")
-
-        ingredients_text = "\n".join([
-            f"- {ing['name']}: {ing['quantity']} {ing['unit']}"
-            for ing in available_ingredients
-        ])
-        
-        # For recipe requests, construct the detailed prompt
-        # Use current_user_prompt which is guaranteed to be non-empty here for user's actual request
-        base_prompt_text = f"""
-        Available ingredients in pantry:
-        {ingredients_text}
-        
-        User's request: "{current_user_prompt}"
-
-        Consider these guidelines when suggesting recipes:
-        1. Prioritize recipes that best match the user's request and utilize the available ingredients.
-        2. If the user's request is vague, suggest diverse and practical recipes.
-        3. Include common pantry staples (like salt, pepper, oil, basic spices) in the recipe's ingredient list if they are typically assumed and not explicitly in the pantry list. Do not list them if the recipe doesn't need them.
-        4. Only list the quantities of provided pantry ingredients that are actually needed for the recipe if a specific quantity is mentioned in the pantry.
-        5. If a specific recipe is requested but ingredients are insufficient, politely explain what's missing or suggest alternatives.
-        6. Provide clear, step-by-step instructions.
-        """
+        if parsed_json.get("type") == "recipes" and isinstance(parsed_json.get("recipes"), list):
+            return {"recipes": parsed_json["recipes"]}
+        return {"chat_response": parsed_json.get("message", "")}
 
-        recipe_system_prompt_template = ChatPromptTemplate.from_messages([
-            ("system", """You are a helpful and friendly cooking and kitchen assistant.
-            
-            If the user's request, combined with any provided ingredients, seems to be asking for specific RECIPES, 
-            then you MUST respond with a JSON object adhering to this exact structure:
-            {{
-                "recipes": [
-                    {{
-                        "name": "Recipe Name",
-                        "description": "Brief description",
-                        "ingredients": [
-                            {{"name": "ingredient name", "quantity": 1.0, "unit": "unit"}}
-                        ],
-                        "instructions": ["step 1", "step 2", "..."],
-                        "cooking_time": "30 minutes (e.g., '20-25 minutes', 'About 1 hour')",
-                        "difficulty": "Easy/Medium/Hard",
-                        "confidence_score": 0.9 (a float between 0.0 and 1.0 indicating match with available ingredients and request)
-                    }}
-                ]
-            }}
-            Ensure the ingredients list in the JSON only contains items needed for the recipe. The confidence_score should reflect how well the recipe aligns with the user's available ingredients and specific request.
-            
-            If the user's request is food-related but not a clear recipe request (e.g., asking for variations of a dish, advice on a partially described recipe, or a follow-up question about a previously suggested recipe that doesn't require a new full recipe JSON),
-            then you MAY respond conversationally in plain text. DO NOT use the JSON format for these specific conversational follow-ups or advice if a full new recipe JSON is not appropriate.
-            Be friendly and informative in your conversational replies.
-            """),
-            ("user", "{user_recipe_request_and_ingredients}") # Using a named variable for the combined context
-        ])
+    async def get_recipe_recommendations(self, available_ingredients: List[Dict], user_prompt: str = None) -> Dict:
+        current_user_prompt = _resolve_user_prompt(available_ingredients, user_prompt)
+        if current_user_prompt is None:
+            # Nothing to cook with and nothing asked, the answer doesn't need the model
+            return {"chat_response": _EMPTY_PANTRY_MESSAGE}
 
         try:
-            formatted_recipe_prompt = recipe_system_prompt_template.format_prompt(user_recipe_request_and_ingredients=base_prompt_text)
-            recipe_messages = formatted_recipe_prompt.to_messages()
+            recipe_messages = self._build_recipe_messages(available_ingredients, current_user_prompt)
             response = await self.llm_creative.ainvoke(recipe_messages)
-            content = response.content.strip()
-            
-            if content.startswith("```json"):
-                content = content[len("```json"):].strip()
-                if content.endswith("```"):
-                    content = content[:-len("```")]
-            elif content.startswith("```") and content.endswith("```"):
-                content = content[len("```"):-(len("```"))].strip()
-
-            try:
-                parsed_json = json.loads(content)
-                if isinstance(parsed_json, dict) and "recipes" in parsed_json and isinstance(parsed_json["recipes"], list):
-                    return parsed_json 
-                else:
-                    # If JSON is valid but not recipe structure, or AI gave conversational response to recipe request
-                    return {"chat_response": content} 
-            except json.JSONDecodeError:
-                # If JSON parsing fails, it's a plain text conversational response to a recipe request
-                return {"chat_response": content}
+            return self._parse_reply(response.content.strip())
 
         except Exception as e:
-            print(f"Error in recipe recommendation stage: {e}") 
-            error_message = "I encountered an issue trying to find recipes or answer your food question. Please try again."
+            log.exception("Error in recipe recommendation stage: %s", e)
+            error_message = _RECOMMENDATION_ERROR_MESSAGE
             if 'response' in locals() and hasattr(response, 'content') and response.content:
-                 error_message = f"An error occurred with recipes. Raw AI response: {response.content}"
+                 error_message = _RAW_RESPONSE_ERROR_MESSAGE.format(response.content)
             return {"chat_response": error_message, "error": True}
 
-    async def confirm_recipe_usage(self, recipe: Dict, available_ingredients: List[Dict]) -> Dict:
-        available_text = "\n".join([
-            f"- {ing['name']}: {ing['quantity']} {ing['unit']}"
-            for ing in available_ingredients
-        ])
-        recipe_text = f"""
-        Recipe: {recipe['name']}
-        Ingredients needed:
-        {chr(10).join([f'- {ing["name"]}: {ing["quantity"]} {ing["unit"]}' for ing in recipe['ingredients']])}
+    async def stream_recipe_recommendations(self, available_ingredients: List[Dict], user_prompt: str = None) -> AsyncIterator[Dict]:
+        """Like get_recipe_recommendations, but yields {"recipe": ...} for each recipe as soon as the model finishes it.
+
+        Chat replies and errors are yielded once, in the same shape get_recipe_recommendations returns them.
         """
+        current_user_prompt = _resolve_user_prompt(available_ingredients, user_prompt)
+        if current_user_prompt is None:
+            yield {"chat_response": _EMPTY_PANTRY_MESSAGE}
+            return
 
-        usage_prompt_template = ChatPromptTemplate.from_messages([
-            ("system", """You are a helpful cooking assistant that helps track ingredient usage.
-            Calculate the remaining quantities of ingredients after using this recipe.
-            Consider:
-            1. Subtract used quantities from available quantities
-            2. Handle unit conversions if necessary (though the input units should generally be consistent)
-            3. Return 0 for ingredients that are completely used
-            4. Keep track of ingredients that weren't used in the recipe (these should be returned with their original quantities)
-            5. If there is an extra ingredient in the recipe that is not from available ingredients, ignore it for calculation purposes.
-            
-            IMPORTANT: Return ONLY a JSON object with this exact structure, no explanations or additional text:
-            {{
-                "remaining_ingredients": [
-                    {{
-                        "name": "ingredient name",
-                        "quantity": 1.0, // or remaining quantity
-                        "unit": "unit",
-                        "category": "category name" // ensure to pass through category from available_ingredients
-                    }}
-                ]
-            }}
-            Include ALL ingredients from the original 'available_ingredients' list in the 'remaining_ingredients' output, \
-            updating quantities for those used, and keeping original quantities for those not used.
-            """),
-            ("user", """Available ingredients (with categories):
-{available_text_input}
+        chunks = []
+        try:
+            recipe_messages = self._build_recipe_messages(available_ingredients, current_user_prompt)
+            decoder = None
+            recipes_yielded = False
+            async for chunk in self.llm_creative.astream(recipe_messages):
+                if not chunk.content:
+                    continue
+                chunks.append(chunk.content)
+                if decoder is None:
+                    match = _RECIPES_ARRAY_RE.search("".join(chunks))
+                    if not match:
+                        continue
+                    decoder = ArrayItemDecoder()
+                    new_text = "".join(chunks)[match.end() - 1:]  # Keep the opening bracket
+                else:
+                    new_text = chunk.content
+                for recipe in decoder.feed(new_text):
+                    recipes_yielded = True
+                    yield {"recipe": recipe}
+        except Exception as e:
+            log.exception("Error in streamed recipe recommendation stage: %s", e)
+            error_message = _RECOMMENDATION_ERROR_MESSAGE
+            if chunks:
+                error_message = _RAW_RESPONSE_ERROR_MESSAGE.format("".join(chunks))
+            yield {"chat_response": error_message, "error": True}
+            return
 
-Recipe to prepare:
-{recipe_text_input}
+        if recipes_yielded:
+            return
+        # Chat reply, or recipes the decoder could not pick out, so parse the full response instead
+        reply = self._parse_reply("".join(chunks).strip())
+        if "recipes" in reply:
+            for recipe in reply["recipes"]:
+                yield {"recipe": recipe}
+        else:
+            yield reply
 
-Calculate remaining ingredients after preparing this recipe.
-Return ONLY the JSON object with ALL original ingredients, updated quantities for used ones.
-Preserve the category for each ingredient as provided in the available list.""")
-        ])
+    async def confirm_recipe_usage(self, recipe: Dict, available_ingredients: List[Dict]) -> Dict:
+        if not recipe.get("ingredients"):
+            return {"remaining_ingredients": available_ingredients}
+
+        remaining, conflicts = _subtract_locally(recipe, available_ingredients)
+        if not conflicts:
+            return {"remaining_ingredients": remaining}
+
+        # Units differ for some ingredients, so only those need the model for conversion
+        conflict_names = {ing["name"].lower() for ing in conflicts}
+        result = await self.confirm_recipe_usage_batch(
+            [{"name": recipe["name"], "ingredients": conflicts}],
+            [ing for ing in available_ingredients if ing["name"].lower() in conflict_names]
+        )
+        if "error" in result:
+            return {"remaining_ingredients": [], "error": result["error"]}
+
+        # The model worked from the original quantities, so apply only the amount it used
+        original = {ing["name"].lower(): ing["quantity"] for ing in available_ingredients}
+        for converted in result["results"][0]:
+            name = converted.get("name", "").lower()
+            if name not in conflict_names:
+                continue
+            used = original[name] - float(converted.get("quantity") or 0)
+            for ing in remaining:
+                if ing["name"].lower() == name:
+                    ing["quantity"] = max(ing["quantity"] - used, 0)
+        return {"remaining_ingredients": remaining}
+
+    async def confirm_recipe_usage_batch(self, recipes: List[Dict], available_ingredients: List[Dict]) -> Dict:
+        if not recipes:
+            return {"results": []}
 
         try:
-            formatted_usage_prompt = usage_prompt_template.format_prompt(
+            # The pantry is sent once for all recipes, each recipe is calculated against it independently
+            available_text = _format_pantry(available_ingredients)
+            recipes_text = "\n".join([
+                f"[{index}] Recipe: {recipe['name']}\n"
+                "Ingredients needed:\n"
+                + _format_pantry(recipe['ingredients'])
+                for index, recipe in enumerate(recipes)
+            ])
+            usage_messages = self._usage_tmpl.format_messages(
                 available_text_input=available_text,
-                recipe_text_input=recipe_text
+                recipes_text_input=recipes_text
             )
-            usage_messages = formatted_usage_prompt.to_messages()
             response = await self.llm_direct.ainvoke(usage_messages)
-            content = response.content.strip()
-            
-            if content.startswith("```json"):
-                content = content[len("```json"):].strip()
-                if content.endswith("```"):
-                    content = content[:-len("```")]
-            elif content.startswith("```") and content.endswith("```"):
-                content = content[len("```"):-(len("```"))].strip()
-            
-            return json.loads(content.strip())
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response in confirm_recipe_usage: {e}")
-            print(f"Raw response from confirm_recipe_usage: {response.content}")
-            return {"remaining_ingredients": [], "error": "Failed to parse ingredient update response."}
+            results = sorted(orjson.loads(response.content)["results"], key=lambda r: r["recipe_index"])
+            if len(results) != len(recipes):
+                log.warning("Expected %d usage results, got %d", len(recipes), len(results))
+                return {"results": [], "error": "Ingredient update response did not cover every recipe."}
+            return {"results": [r["remaining_ingredients"] for r in results]}
         except Exception as e:
-            print(f"Error calculating remaining ingredients: {e}")
-            return {"remaining_ingredients": [], "error": "Failed to calculate remaining ingredients."} 
+            log.exception("Error calculating remaining ingredients: %s", e)
+            return {"results": [], "error": "Failed to calculate remaining ingredients."}